@@ -1,10 +1,18 @@
 
 import io
+import os
+import re
 import math
 import pandas as pd
 import numpy as np
+import numexpr as ne
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import streamlit as st
 
+# Copy-on-Write: column writes copy only what they touch, so no defensive deep copies
+pd.set_option("mode.copy_on_write", True)
+
 st.set_page_config(
     page_title="Brand Analytics • Query Opportunity Analyzer",
     page_icon="🧠",
@@ -43,6 +51,9 @@ hr.soft { border: none; height:1px; background: rgba(255,255,255,0.08); margin:
 st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
 
 # ---------- Helpers ----------
+# per-function LRU bound for st.cache_data: keeps memory flat on a shared server
+CACHE_MAX_ENTRIES = 6
+
 PCT_COLS_CANON = [
     "Our Conversion Rate",
     "Market Conversion Rate",
@@ -76,67 +87,86 @@ DELTA_COLS_CANON = [
     "Delta - Add to Cart to Purchases",
 ]
 
-def _clean_col(c: str) -> str:
-    if c is None:
-        return ""
-    c = str(c).strip()
-    c = c.replace("\n", " ")
-    c = re.sub(r"\s+", " ", c)
-    # normalize common typos / spacing
-    c = c.replace("Our Conversion Rate ", "Our Conversion Rate")
-    c = c.replace("Add to Cart - ASIN Share ", "Add to Cart - ASIN Share")
-    c = c.replace("Impressions - ASIN Share", "Impressions - ASIN Share")
-    c = c.replace("Clicks - ASIN Share", "Clicks - ASIN Share")
-    c = c.replace("Purchases - ASIN Share", "Purchases - ASIN Share")
-    c = c.replace("Delta - Impressions to Clicks", "Delta - Impressions to Clicks")
-    c = c.replace("Delta - Clicks to Add to Cart", "Delta - Clicks to Add to Cart")
-    c = c.replace("Delta - Add to Cart to Purchases", "Delta - Add to Cart to Purchases")
-    return c
-
-def _to_number(x):
-    if pd.isna(x):
-        return np.nan
-    if isinstance(x, (int, float, np.integer, np.floating)):
-        return float(x)
-    s = str(x).strip()
-    if s == "":
-        return np.nan
-    # handle percents like "3.2%" or "0.032"
-    if s.endswith("%"):
-        try:
-            return float(s[:-1].replace(",", "")) / 100.0
-        except:
-            return np.nan
-    # handle commas
-    s = s.replace(",", "")
-    try:
-        return float(s)
-    except:
-        return np.nan
+ACTION_BY_BUCKET = {
+    "Ranking Opportunity": "Launch/expand Exact + POE rank; validate relevance; tighten top-of-search placements; add to PLO (title/bullets/back-end) if truly core.",
+    "Conversion Problem": "Fix listing first (main image/value props/price/reviews); then isolate query in Exact to measure; avoid brute-force spend.",
+    "PPC Scaling Opportunity": "Scale PPC deliberately: raise bids/budgets where CPS holds; broaden match types; add defense targets; watch TACoS.",
+    "Defend Position": "Defend: maintain Exact + defense; cap waste; monitor share drops weekly.",
+}
+# "Ignore / Low Signal" and anything unexpected
+DEFAULT_ACTION = "Ignore for now, or investigate relevance if it keeps appearing."
+
+_WS_RE = re.compile(r"\s+")
+
+def _clean_cols(cols) -> list:
+    # one vectorized pass over all column names (None -> "")
+    idx = pd.Index(cols, dtype=object).fillna("").astype(str).str.strip()
+    # collapses newlines and stray/trailing spacing, e.g. "Our Conversion Rate " -> "Our Conversion Rate"
+    return idx.str.replace(_WS_RE, " ", regex=True).tolist()
+
+def _to_numeric(series: pd.Series) -> pd.Series:
+    # fast path: already numeric, nothing to parse
+    if pd.api.types.is_numeric_dtype(series):
+        return pd.to_numeric(series, errors="coerce").astype("float64")
+    s = series.astype(str).str.strip().str.replace(",", "", regex=False)
+    return pd.to_numeric(s, errors="coerce").astype("float64")
 
 def _coerce_percent(series: pd.Series) -> pd.Series:
-    s = series.apply(_to_number)
+    if pd.api.types.is_numeric_dtype(series):
+        out = series.to_numpy(dtype="float64")
+    else:
+        # handle percents like "3.2%" or "0.032" (and commas) in one vectorized pass
+        s = series.astype(str).str.strip()
+        has_pct = s.str.endswith("%").to_numpy()
+        s = s.str.replace(",", "", regex=False).str.rstrip("%").str.strip()
+        out = pd.to_numeric(s, errors="coerce").to_numpy(dtype="float64")
+        out = np.where(has_pct, out / 100.0, out)
     # if values look like 3.2 (already percent points), convert to fraction
     # heuristic: if median > 1, treat as percent points
-    med = np.nanmedian(s.values) if np.isfinite(s.values).any() else np.nan
-    if pd.notna(med) and med > 1.0:
-        s = s / 100.0
-    return s
-
-def load_anything(uploaded_file) -> pd.DataFrame:
-    name = uploaded_file.name.lower()
-    content = uploaded_file.read()
+    # an all-NaN or empty column gives a NaN median (numpy emits a harmless RuntimeWarning)
+    if np.nanmedian(out) > 1.0:  # False for a NaN median
+        out = out / 100.0
+    return pd.Series(out, index=series.index)
+
+def _col_or_nan(df: pd.DataFrame, c: str) -> np.ndarray:
+    # only allocate the NaN filler when the column is actually missing
+    return df[c].to_numpy(dtype="float64") if c in df.columns else np.full(len(df), np.nan)
+
+def _dedupe_names(names) -> list:
+    # "Delta", "Delta" -> "Delta", "Delta.1"; skips suffixes already in the header,
+    # same as pd.read_csv's C engine
+    names = list(names)
+    counts = {}
+    for i, col in enumerate(names):
+        old_col = col
+        cur_count = counts.get(col, 0)
+        while cur_count > 0:
+            counts[old_col] = cur_count + 1
+            col = f"{old_col}.{cur_count}"
+            cur_count = cur_count + 1 if col in names else counts.get(col, 0)
+        names[i] = col
+        counts[col] = cur_count + 1
+    return names
+
+def load_anything(content: bytes, name: str) -> pd.DataFrame:
+    name = name.lower()
     if name.endswith(".csv"):
-        df = pd.read_csv(io.BytesIO(content))
+        # multithreaded Arrow parser; arrow-backed columns keep string memory down.
+        # Arrow tables allow repeated headers (e.g. two "Delta" columns) but to_pandas doesn't,
+        # so mangle them like pandas' C engine before converting.
+        table = pacsv.read_csv(io.BytesIO(content), parse_options=pacsv.ParseOptions(newlines_in_values=True))
+        table = table.rename_columns(_dedupe_names(table.column_names))
+        df = table.to_pandas(types_mapper=pd.ArrowDtype)
     else:
-        # excel
-        xls = pd.ExcelFile(io.BytesIO(content))
-        # choose best sheet by column match
+        # excel (calamine: Rust streaming parser, much faster than openpyxl)
+        # open the workbook once and reuse the handle for every sheet
+        xls = pd.ExcelFile(io.BytesIO(content), engine="calamine")
+        # choose best sheet by column match (headers only)
         best = None
         best_score = -1
         for sh in xls.sheet_names:
-            temp = pd.read_excel(xls, sheet_name=sh)
-            cols = [_clean_col(c) for c in temp.columns]
+            temp = pd.read_excel(xls, sheet_name=sh, nrows=0)
+            cols = _clean_cols(temp.columns)
             score = 0
             for must in ["Keyword", "Purchases: Total Count", "Clicks: Total Count", "Impressions: Total Count"]:
                 if must in cols:
@@ -148,13 +178,14 @@ def load_anything(uploaded_file) -> pd.DataFrame:
                 best_score = score
                 best = sh
         df = pd.read_excel(xls, sheet_name=best)
-    df.columns = [_clean_col(c) for c in df.columns]
+    df.columns = _clean_cols(df.columns)
     return df
 
 def prep_df(df: pd.DataFrame) -> pd.DataFrame:
     # rename legacy delta columns into canon
     # Some sheets call them just "Delta" twice; we disambiguate if needed.
-    df = df.copy()
+    # shallow copy: under CoW the data is shared until a column is actually written
+    df = df.copy(deep=False)
 
     # Fix duplicate "Delta" columns by positional expectations
     cols = list(df.columns)
@@ -179,7 +210,7 @@ def prep_df(df: pd.DataFrame) -> pd.DataFrame:
 
     for c in NUM_COLS_CANON:
         if c in df.columns:
-            df[c] = df[c].apply(_to_number)
+            df[c] = _to_numeric(df[c])
 
     for c in ["Delta - Impressions to Clicks", "Delta - Clicks to Add to Cart", "Delta - Add to Cart to Purchases"]:
         if c in df.columns:
@@ -187,72 +218,108 @@ def prep_df(df: pd.DataFrame) -> pd.DataFrame:
 
     # Drop empty keywords
     if "Keyword" in df.columns:
+        # check nulls before astype(str): arrow-backed nulls stringify as "<NA>", not "nan"
+        has_kw = df["Keyword"].notna()
         df["Keyword"] = df["Keyword"].astype(str).str.strip()
-        df = df[df["Keyword"].ne("") & df["Keyword"].ne("nan")]
+        df = df[has_kw & df["Keyword"].ne("") & df["Keyword"].ne("nan")]
 
     # Derived fields
-    df["Market_Demand"] = df.get("Impressions: Total Count", np.nan)
-    if df["Market_Demand"].isna().all():
-        df["Market_Demand"] = df.get("Clicks: Total Count", np.nan)
+    demand = _col_or_nan(df, "Impressions: Total Count")
+    if np.isnan(demand).all():
+        demand = _col_or_nan(df, "Clicks: Total Count")
+    df["Market_Demand"] = demand
 
     # Opportunity features
-    df["ClickGap"] = (df.get("Market Click Through Rate", np.nan) - df.get("Our Click Through Rate", np.nan))
-    df["ConvGap"]  = (df.get("Market Conversion Rate", np.nan) - df.get("Our Conversion Rate", np.nan))
-    df["ShareGap_Clicks"] = (df.get("Clicks - ASIN Share", np.nan) - df.get("Impressions - ASIN Share", np.nan))
-    df["ShareGap_Purchases"] = (df.get("Purchases - ASIN Share", np.nan) - df.get("Clicks - ASIN Share", np.nan))
+    imps = _col_or_nan(df, "Impressions - ASIN Share")
+    clks = _col_or_nan(df, "Clicks - ASIN Share")
+    purs = _col_or_nan(df, "Purchases - ASIN Share")
+    df["ClickGap"] = np.subtract(_col_or_nan(df, "Market Click Through Rate"), _col_or_nan(df, "Our Click Through Rate"))
+    df["ConvGap"]  = np.subtract(_col_or_nan(df, "Market Conversion Rate"), _col_or_nan(df, "Our Conversion Rate"))
+    df["ShareGap_Clicks"] = np.subtract(clks, imps)
+    df["ShareGap_Purchases"] = np.subtract(purs, clks)
 
     # Normalize demand (log scale to reduce outliers)
-    d = df["Market_Demand"].fillna(0).clip(lower=0)
-    df["DemandScore"] = np.log1p(d)
-    if df["DemandScore"].max() > 0:
-        df["DemandScore"] = df["DemandScore"] / df["DemandScore"].max()
+    # one working buffer: fillna(0) copy, then clip/log1p/divide in place
+    ds = np.nan_to_num(demand, nan=0.0)
+    np.clip(ds, 0, None, out=ds)
+    np.log1p(ds, out=ds)
+    m = ds.max() if ds.size else 0.0
+    if m > 0:
+        np.divide(ds, m, out=ds)
+    df["DemandScore"] = ds
 
     # Score: prioritize demand + (positive) gaps
-    def pos(x): 
-        return np.where(pd.isna(x), 0, np.maximum(x, 0))
-    df["OpportunityScore"] = (
-        0.55 * df["DemandScore"]
-        + 0.20 * pos(df["ClickGap"])
-        + 0.15 * pos(df["ConvGap"])
-        + 0.10 * pos(df["ShareGap_Purchases"])
-    )
-    df["OpportunityScore"] = df["OpportunityScore"].fillna(0)
+    # one fused numexpr pass; NaN gaps fail the >0 test and count as 0
+    cg = df["ClickGap"].to_numpy(dtype="float64")
+    cv = df["ConvGap"].to_numpy(dtype="float64")
+    sp = df["ShareGap_Purchases"].to_numpy(dtype="float64")
+    score = ne.evaluate("0.55*ds + 0.20*where(cg>0, cg, 0) + 0.15*where(cv>0, cv, 0) + 0.10*where(sp>0, sp, 0)")
+    np.nan_to_num(score, copy=False)
+    df["OpportunityScore"] = score
 
     # Buckets (simple, deterministic rules)
-    imp_share = df.get("Impressions - ASIN Share", pd.Series(np.nan, index=df.index))
-    clk_share = df.get("Clicks - ASIN Share", pd.Series(np.nan, index=df.index))
-    pur_share = df.get("Purchases - ASIN Share", pd.Series(np.nan, index=df.index))
-
-    df["Bucket"] = "Ignore / Low Signal"
-    # Ranking opp: demand high, impressions share exists, clicks/purchases lag
-    df.loc[(df["DemandScore"] > 0.55) & (imp_share > 0) & (clk_share < imp_share*0.85), "Bucket"] = "Ranking Opportunity"
-    # Conversion issue: you get clicks but purchases lag
-    df.loc[(df["DemandScore"] > 0.35) & (clk_share > 0) & (pur_share < clk_share*0.75), "Bucket"] = "Conversion Problem"
-    # PPC scale: purchases share >= clicks share (good conversion) but low impression share
-    df.loc[(df["DemandScore"] > 0.35) & (pur_share >= clk_share*0.95) & (imp_share < 0.06), "Bucket"] = "PPC Scaling Opportunity"
-    # Defend: strong shares
-    df.loc[(imp_share >= 0.08) & (pur_share >= 0.06), "Bucket"] = "Defend Position"
+    # np.select picks the first match, so rules are listed highest precedence first
+    # (NaN comparisons are False, so missing shares never match a rule)
+    conds = [
+        # Defend: strong shares
+        (imps >= 0.08) & (purs >= 0.06),
+        # PPC scale: purchases share >= clicks share (good conversion) but low impression share
+        (ds > 0.35) & (purs >= clks*0.95) & (imps < 0.06),
+        # Conversion issue: you get clicks but purchases lag
+        (ds > 0.35) & (clks > 0) & (purs < clks*0.75),
+        # Ranking opp: demand high, impressions share exists, clicks/purchases lag
+        (ds > 0.55) & (imps > 0) & (clks < imps*0.85),
+    ]
+    choices = ["Defend Position", "PPC Scaling Opportunity", "Conversion Problem", "Ranking Opportunity"]
+    df["Bucket"] = np.select(conds, choices, default="Ignore / Low Signal")
 
     # Suggested action text
-    def action(row):
-        b = row["Bucket"]
-        if b == "Ranking Opportunity":
-            return "Launch/expand Exact + POE rank; validate relevance; tighten top-of-search placements; add to PLO (title/bullets/back-end) if truly core."
-        if b == "Conversion Problem":
-            return "Fix listing first (main image/value props/price/reviews); then isolate query in Exact to measure; avoid brute-force spend."
-        if b == "PPC Scaling Opportunity":
-            return "Scale PPC deliberately: raise bids/budgets where CPS holds; broaden match types; add defense targets; watch TACoS."
-        if b == "Defend Position":
-            return "Defend: maintain Exact + defense; cap waste; monitor share drops weekly."
-        return "Ignore for now, or investigate relevance if it keeps appearing."
-    df["Suggested Action"] = df.apply(action, axis=1)
+    df["Suggested Action"] = df["Bucket"].map(ACTION_BY_BUCKET).fillna(DEFAULT_ACTION)
+
+    # Narrow dtypes: rates/shares don't need float64, and buckets/actions have ~5 distinct values
+    for c in PCT_COLS_CANON + SHARE_COLS_CANON + DELTA_COLS_CANON + ["DemandScore", "OpportunityScore", "ClickGap", "ConvGap", "ShareGap_Clicks", "ShareGap_Purchases"]:
+        if c in df.columns:
+            df[c] = df[c].astype("float32")
+    df["Bucket"] = df["Bucket"].astype("category")
+    df["Suggested Action"] = df["Suggested Action"].astype("category")
+
+    # Top 12 for the "What you do next" panel: partial sort (O(N)), computed once per upload.
+    # Stored as index labels -- a DataFrame in attrs breaks pandas' attrs equality checks (concat/nlargest).
+    k = min(12, len(df))
+    top_idx = np.argpartition(-df["OpportunityScore"].to_numpy(), k - 1)[:k] if k else []
+    df.attrs["top12"] = df.iloc[top_idx].sort_values("OpportunityScore", ascending=False).index.tolist()
 
     return df
 
-def fmt_pct(x):
-    if pd.isna(x):
-        return ""
-    return f"{x*100:.2f}%"
+DEMO_PATH = "Wynwood Search Query Performance Analyzer.xlsx"
+
+# Load + prep are cached together, keyed on inputs Streamlit hashes cheaply and exactly
+# (upload bytes, demo path + mtime) -- never on a DataFrame, which is re-hashed every rerun
+# and only sampled above 100k rows. Both return None for an empty sheet.
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def load_and_prep(content: bytes, name: str):
+    # keyed on raw bytes + filename (UploadedFile itself is not hashable)
+    df_raw = load_anything(content, name)
+    return None if df_raw.empty else prep_df(df_raw)
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def load_demo(path: str, mtime: float):
+    # mtime is only part of the cache key, so edits to the file invalidate it
+    # pass the path, not bytes: calamine opens the file itself and parses only this sheet
+    df_raw = pd.read_excel(path, sheet_name="Data - Final", engine="calamine")
+    df_raw.columns = _clean_cols(df_raw.columns)
+    return None if df_raw.empty else prep_df(df_raw)
+
+def to_csv_bytes(df: pd.DataFrame) -> bytes:
+    # Arrow's C++ CSV writer; not cached -- encoding <= max_rows rows is cheaper than hashing them
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # object columns mixing Python types (e.g. 500 and "1,200" from Excel) can't become Arrow
+        return df.to_csv(index=False).encode("utf-8")
+    buf = io.BytesIO()
+    pacsv.write_csv(table, buf)
+    return buf.getvalue()
 
 # ---------- Sidebar ----------
 st.sidebar.markdown("### ⚙️ Controls")
@@ -268,24 +335,24 @@ use_demo = st.sidebar.toggle("Load demo from Wynwood analyzer (local)", value=Tr
 st.sidebar.caption("Turn off if you want to upload your own export.")
 
 # ---------- Load data ----------
-df_raw = None
+df = None
 if uploaded:
-    df_raw = load_anything(uploaded)
+    try:
+        df = load_and_prep(uploaded.getvalue(), uploaded.name)
+    except Exception as e:
+        st.error(f"Could not read {uploaded.name}. {e}")
 elif use_demo:
     try:
-        df_raw = pd.read_excel("Wynwood Search Query Performance Analyzer.xlsx", sheet_name="Data - Final")
-        df_raw.columns = [_clean_col(c) for c in df_raw.columns]
+        df = load_demo(DEMO_PATH, os.path.getmtime(DEMO_PATH))
     except Exception as e:
         st.error(f"Could not load demo file. {e}")
 
-if df_raw is None or df_raw.empty:
+if df is None:
     st.markdown('<div class="big-title">Brand Analytics • Query Opportunity Analyzer</div>', unsafe_allow_html=True)
     st.markdown("Upload a Brand Analytics Search Query export to get a prioritized, action-ready list.")
     st.info("Tip: Export Search Query Performance (Brand Analytics) → upload here. The app will auto-detect columns.")
     st.stop()
 
-df = prep_df(df_raw)
-
 # ---------- Header ----------
 colA, colB = st.columns([3, 2])
 with colA:
@@ -323,12 +390,13 @@ with st.expander("🔎 Filters", expanded=True):
     with c4:
         max_rows = st.slider("Max rows to show", 25, 250, 75, 25)
 
-df_f = df.copy()
+# combine all filters into one mask -> a single gather, then a partial sort for the top rows
+mask = (df["OpportunityScore"] >= min_score).to_numpy()
 if q:
-    df_f = df_f[df_f["Keyword"].str.contains(q, case=False, na=False)]
+    mask = mask & df["Keyword"].str.contains(q, case=False, na=False, regex=False).to_numpy()
 if bucket != "All":
-    df_f = df_f[df_f["Bucket"] == bucket]
-df_f = df_f[df_f["OpportunityScore"] >= min_score].sort_values("OpportunityScore", ascending=False).head(max_rows)
+    mask = mask & (df["Bucket"] == bucket).to_numpy()
+df_f = df.loc[mask].nlargest(max_rows, "OpportunityScore")
 
 # ---------- Main Table ----------
 left, right = st.columns([2.2, 1])
@@ -343,26 +411,31 @@ with left:
         "Our Conversion Rate", "Market Conversion Rate",
         "Suggested Action",
     ]
-    show = df_f[[c for c in display_cols if c in df_f.columns]].copy()
+    show = df_f[[c for c in display_cols if c in df_f.columns]]
+    # format percents at render time; the underlying values stay numeric (and sort as numbers)
+    pct_cols = [c for c in ["Impressions - ASIN Share", "Clicks - ASIN Share", "Purchases - ASIN Share",
+                            "Our Click Through Rate", "Market Click Through Rate", "Our Conversion Rate", "Market Conversion Rate"]
+                if c in show.columns]
+    # every numeric column needs an explicit format: a Styler otherwise renders them at precision 6
+    fmts = {c: "{:.2%}" for c in pct_cols}
+    fmts.update({c: "{:,.0f}" for c in ["Impressions: Total Count", "Clicks: Total Count", "Purchases: Total Count"] if c in show.columns})
     if "OpportunityScore" in show.columns:
-        show["OpportunityScore"] = show["OpportunityScore"].round(3)
-    for c in ["Impressions - ASIN Share", "Clicks - ASIN Share", "Purchases - ASIN Share",
-              "Our Click Through Rate", "Market Click Through Rate", "Our Conversion Rate", "Market Conversion Rate"]:
-        if c in show.columns:
-            show[c] = show[c].apply(fmt_pct)
+        fmts["OpportunityScore"] = "{:.3f}"
+    styler = show.style.format(fmts, na_rep="")
 
-    st.dataframe(show, use_container_width=True, height=520)
+    st.dataframe(styler, use_container_width=True, height=520)
 
     # Export
-    csv = df_f.to_csv(index=False).encode("utf-8")
+    csv = to_csv_bytes(df_f)
     st.download_button("⬇️ Download filtered results (CSV)", data=csv, file_name="brand_analytics_opportunities.csv", mime="text/csv")
 
 with right:
     st.subheader("What you do next")
-    top = df.sort_values("OpportunityScore", ascending=False).head(12)
-    for _, r in top.iterrows():
-        st.markdown(f"**{r['Keyword']}**  \n`{r['Bucket']}`  \n{r['Suggested Action']}")
-        st.markdown("---")
+    top = df.loc[df.attrs["top12"]]
+    # build all entries at once and render them in a single markdown call
+    chunks = ("**" + top["Keyword"].astype(str) + "**  \n`" + top["Bucket"].astype(str) + "`  \n" + top["Suggested Action"].astype(str)).tolist()
+    if chunks:
+        st.markdown("\n\n---\n\n".join(chunks) + "\n\n---")
 
 st.markdown("")
 st.caption("Note: This MVP uses deterministic scoring. Next step is adding your playbook + a GPT step that writes ClickUp-ready tasks and weekly summaries in your voice.")